@@ -21,7 +21,7 @@ class ClassifyQuestion(dspy.Signature):
     """
     
     question: str = dspy.InputField(desc="The user's natural language query.")
-    label: str = dspy.OutputField(desc="Output exactly one word: rag, sql, or hybrid")
+    label: Literal['rag', 'sql', 'hybrid'] = dspy.OutputField(desc="Output exactly one word: rag, sql, or hybrid")
 
 # 3. Planner Signature (For Hybrid/RAG extraction)
 class ExtractSearchTerms(dspy.Signature):
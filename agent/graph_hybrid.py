@@ -1,81 +1,122 @@
 import os
+import io
+import asyncio
 import json
 import re
+import hashlib
+import sqlite3
+import threading
 import dspy
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
 from typing import List, Dict, TypedDict
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite import SqliteSaver
 
 # Internal imports
-from .tools.sqlite_tool import SQLiteTool
-from .rag.retrieval import LocalRetriever
-from .dspy_signatures import GenerateSearchQuery, ClassifyQuestion, ExtractSearchTerms, GenerateSQL, GenerateAnswer
+from .tools.sqlite_tool import SQLiteTool, DEFAULT_TABLES
+from .rag.retrieval import get_retriever
+from .llm_cache import CachedModule
+from .ollama_client import OLLAMA_API_BASE, OLLAMA_MODEL, KEEP_ALIVE, NUM_CTX, ConstrainedRouter, warm_up
+from .dspy_signatures import GenerateSearchQuery, ExtractSearchTerms, GenerateSQL, GenerateAnswer
+
+# GRAPH_VIZ_ONLY=1: callers that only need the graph structure (visualize_graph.py) skip
+# everything below that touches Ollama, the database, the docs index or the checkpoint DB
+GRAPH_VIZ_ONLY = bool(os.environ.get("GRAPH_VIZ_ONLY"))
 
 # --- 0. LM CONFIGURATION ---
-lm = dspy.LM(model="ollama/phi3.5:3.8b-mini-instruct-q4_K_M", api_base="http://localhost:11434")
-dspy.settings.configure(lm=lm)
+if not GRAPH_VIZ_ONLY:
+    lm = dspy.LM(model=f"ollama/{OLLAMA_MODEL}", api_base=OLLAMA_API_BASE,
+                 num_ctx=NUM_CTX, keep_alive=KEEP_ALIVE, max_tokens=256)
+    dspy.settings.configure(lm=lm)
+
+    # Load the model in the background so the first question does not pay the cold start
+    threading.Thread(target=warm_up, daemon=True).start()
 
 # --- 1. SETUP & STATE DEFINITION ---
 
+class Route(IntEnum):
+    RAG = 0
+    SQL = 1
+    HYBRID = 2
+
+class ExecStatus(IntEnum):
+    """Set by the executor so the routing edge is a single integer compare."""
+    OK = 0
+    RETRY = 1
+    GIVE_UP = 2
+
+MAX_RETRIES = 2
+# Rows kept from a query result; the synthesizer only sees the first few, and results are
+# checkpointed with the graph state, so a runaway SELECT should not drag in the whole table
+MAX_RESULT_ROWS = 1000
+
+# route/status are checkpointed, so state holds their plain int values (the serializer only
+# round-trips registered types); IntEnum members compare equal to those ints
 class AgentState(TypedDict):
     id: str
     question: str
     format_hint: str
-    route: str
+    route: int  # Route value
     search_query: str
     search_terms: str
     retrieved_docs: List[Dict]
     sql_query: str
     sql_results: Dict
     retries: int
+    status: int  # ExecStatus value
     error_feedback: str
     final_output: Dict
 
 # Initialize Tools
 db_tool = SQLiteTool()
-retriever = LocalRetriever()
+retriever = None if GRAPH_VIZ_ONLY else get_retriever()
 
-# --- 2. DSPy MODULE LOADING ---
+# The Northwind schema is static: introspect and hash it once instead of on every SQL attempt.
+# The compact one-line-per-table form keeps the SQL prompt short.
+SCHEMA = "" if GRAPH_VIZ_ONLY else db_tool.get_schema(compact=True)
+SCHEMA_HASH = hashlib.sha256(SCHEMA.encode("utf-8")).hexdigest()[:12]
 
-query_gen_module = dspy.Predict(GenerateSearchQuery)
-planner_module = dspy.Predict(ExtractSearchTerms)
-synthesizer_module = dspy.Predict(GenerateAnswer)
+# --- 2. DSPy MODULE LOADING ---
 
-# Load Optimized Router Module
-# NOTE: Disabled loading optimized module to improve stability with Phi-3.5
-print("--- Using Baseline (Unoptimized) Router for Stability ---")
-router_module = dspy.Predict(ClassifyQuestion)
+# max_tokens caps decoding per module; budgets include DSPy's output field markers
+# Fuzzy/semantic hits only for modules whose output is interchangeable between near-duplicate
+# questions; everything that writes SQL or answers is exact-match only
+query_gen_module = CachedModule("query_gen", dspy.Predict(GenerateSearchQuery, max_tokens=64),
+                                fuzzy=True, semantic=True)
+planner_module = CachedModule("planner", dspy.Predict(ExtractSearchTerms, max_tokens=128))
+synthesizer_module = CachedModule("synthesizer", dspy.Predict(GenerateAnswer, max_tokens=192))
+
+# Router Module
+# NOTE: Output is schema-constrained by Ollama to exactly rag|sql|hybrid, which avoids the
+# free-text drift Phi-3.5 showed with the DSPy-formatted (optimized or baseline) router.
+# The few-shot demos come from the frozen training artifact, read once here; the optimizer
+# itself only runs in agent/train_router_module.py.
+ROUTER_PATH = "agent/dspy_modules/optimized_router.json"
+print("--- Using Constrained-Decoding Router ---")
+_router = ConstrainedRouter.from_saved(ROUTER_PATH)
+# Demos change the prompt, so they are part of the cache namespace
+router_module = CachedModule(f"router:{hashlib.sha256(_router.demo_block.encode('utf-8')).hexdigest()[:8]}", _router,
+                             fuzzy=True, semantic=True)
 
 # sql_module_path = "agent/dspy_modules/optimized_sql.json"
 # ... (removed old SQL loading logic) ...
 
 # SQL Generator Module (DSPy Predict - required by assignment)
-sql_gen_module = dspy.Predict(GenerateSQL)
+sql_gen_module = CachedModule("sql_gen", dspy.Predict(GenerateSQL, max_tokens=256), static_fields={"schema": SCHEMA_HASH})
 
 # --- 3. NODE IMPLEMENTATIONS ---
 
 def router_node(state: AgentState):
     print(f"\n--- [Router] Processing: {state['question'][:50]}... ---")
     try:
-        pred = router_module(question=state["question"])
-        raw_label = pred.label.lower().strip()
-        
-        if "hybrid" in raw_label:
-            route = "hybrid"
-        elif "sql" in raw_label:
-            route = "sql"
-        elif "rag" in raw_label:
-            route = "rag"
-        else:
-            print(f"   (Router output unclear: '{raw_label}', defaulting to hybrid)")
-            route = "hybrid"
-            
+        route = Route[router_module(question=state["question"]).label.upper()]
     except Exception as e:
         print(f"   (Router crashed: {e}, defaulting to hybrid)")
-        route = "hybrid"
+        route = Route.HYBRID
     
-    print(f"--- [Router] Classified as: {route} ---")
-    return {"route": route}
+    print(f"--- [Router] Classified as: {route.name.lower()} ---")
+    return {"route": int(route)}
 
 def search_query_generation_node(state: AgentState):
     """Generates a keyword-rich search query."""
@@ -83,44 +124,96 @@ def search_query_generation_node(state: AgentState):
     pred = query_gen_module(question=state["question"])
     return {"search_query": pred.search_query}
 
+# Router and query generation both depend only on the question, so their LLM calls overlap
+def prelude_node(state: AgentState):
+    """Runs the router and the search query generator concurrently."""
+    # A short-lived pool per question: a shared fixed-size one would queue these calls whenever
+    # the batch runner has more questions in flight than it has workers
+    pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prelude")
+    try:
+        # Warm the DB page cache while the LLM calls are in flight
+        pool.submit(db_tool.prefetch)
+        query_future = pool.submit(search_query_generation_node, state)
+        update = router_node(state)
+        if update["route"] == Route.SQL:
+            # Pure SQL never reads the search query; its (wasted) call was hidden behind the router
+            return update
+        update.update(query_future.result())
+        return update
+    finally:
+        pool.shutdown(wait=False)
+
 def retriever_node(state: AgentState):
     print(f"--- [Retriever] Searching docs with query: '{state['search_query']}' ---")
     results = retriever.search(state["search_query"], top_k=3)
     return {"retrieved_docs": results}
 
+# Planner fast path: doc sections are structured enough to read constraints without the LLM
+_RE_SECTION_TITLE = re.compile(r'^Context: .*> (.+)$', re.MULTILINE)
+_RE_ACRONYM = re.compile(r'\(([A-Z]{2,})\)')
+_RE_DATE_RANGE = re.compile(r'(\d{4}-\d{2}-\d{2})\s*(?:to|through|-|–)\s*(\d{4}-\d{2}-\d{2})')
+_RE_FORMULA = re.compile(r'\b(\w+\s*=\s*[^\n]+)')
+
+def extract_constraints(docs: List[Dict], question: str) -> str:
+    """
+    Reads date ranges and formulas from the retrieved sections the question names
+    (e.g. 'Summer Beverages 1997', 'Gross Margin', 'AOV').
+    Returns "" when nothing matches, meaning the LLM planner is needed.
+    """
+    q = question.lower()
+    terms = []
+    for doc in docs:
+        m = _RE_SECTION_TITLE.search(doc["text"])
+        if not m:
+            continue
+        title = m.group(1).strip()
+        names = [re.sub(r'\s*\(.*?\)', '', title)] + _RE_ACRONYM.findall(title)
+        if not any(name.lower() in q for name in names if name):
+            continue
+        terms += [f"Date Range: {start} to {end}" for start, end in _RE_DATE_RANGE.findall(doc["text"])]
+        terms += [f"Formula: {formula.strip()}" for formula in _RE_FORMULA.findall(doc["text"])]
+    return "; ".join(terms)
+
 def planner_node(state: AgentState):
     """Extracts constraints (Requirement #3)."""
     print("--- [Planner] Extracting constraints... ---")
-    context_str = "\n\n".join([d['text'] for d in state.get("retrieved_docs", [])])
+    docs = state.get("retrieved_docs", [])
+    context_str = "\n\n".join([d['text'] for d in docs])
     
     # Even if context is empty, we pass through planner to be safe
     if not context_str:
         return {"search_terms": ""}
+
+    search_terms = extract_constraints(docs, state["question"])
+    if search_terms:
+        print(f"   (Constraints extracted without LLM: {search_terms[:100]})")
+        return {"search_terms": search_terms}
         
     pred = planner_module(context=context_str, question=state["question"])
     return {"search_terms": pred.search_terms}
 
+# Common wrong spellings the LLM generates for "Order Details", as a single alternation
+_RE_ORDER_DETAILS = re.compile(
+    r'\bOrderDetails\b'
+    r'|\bOrder_Details\b'
+    r'|`Order Details`'  # MySQL style
+    r'|\[Order Details\]',  # SQL Server style
+    re.IGNORECASE,
+)
+
+# Numeric answer extraction in the synthesizer
+_RE_INT = re.compile(r'\d+')
+_RE_FLOAT = re.compile(r"[-+]?\d*\.\d+|\d+")
+
+# Table names cited from SQL; longest first so "Order Details" wins over any shorter prefix
+_RE_TABLES = re.compile("|".join(re.escape(t) for t in sorted(DEFAULT_TABLES, key=len, reverse=True)))
+
 def fix_order_details_table(sql: str) -> str:
     """
     Post-process SQL to fix common LLM mistakes with 'Order Details' table name.
     The table MUST be quoted as "Order Details" (with space).
     """
-    import re
-    
-    # Common wrong patterns the LLM generates
-    wrong_patterns = [
-        r'\bOrderDetails\b',
-        r'\bOrder_Details\b', 
-        r'\borderdetails\b',
-        r'\border_details\b',
-        r'`Order Details`',  # MySQL style
-        r'\[Order Details\]',  # SQL Server style
-    ]
-    
-    for pattern in wrong_patterns:
-        sql = re.sub(pattern, '"Order Details"', sql, flags=re.IGNORECASE)
-    
-    return sql
+    return _RE_ORDER_DETAILS.sub('"Order Details"', sql)
 
 def sql_generator_node(state: AgentState):
     """
@@ -130,7 +223,7 @@ def sql_generator_node(state: AgentState):
     attempt = state.get("retries", 0) + 1
     print(f"--- [SQL Generator] Attempt {attempt} ---")
     
-    schema = db_tool.get_schema()
+    schema = SCHEMA
     constraints = state.get("search_terms", "")
     error_msg = state.get("error_feedback", "") if state.get("retries", 0) > 0 else ""
     
@@ -172,19 +265,54 @@ def sql_generator_node(state: AgentState):
 def executor_node(state: AgentState):
     print("--- [Executor] Running SQL... ---")
     query = state["sql_query"]
-    results = db_tool.execute_sql(query)
+    results = db_tool.execute_sql(query, max_rows=MAX_RESULT_ROWS)
     
-    current_retries = state.get("retries", 0)
     if results.get("error"):
         print(f"   (Error: {results['error']})")
-        return {"sql_results": results, "retries": current_retries + 1, "error_feedback": str(results['error'])}
+        retries = state.get("retries", 0) + 1
+        status = ExecStatus.RETRY if retries <= MAX_RETRIES else ExecStatus.GIVE_UP
+        return {"sql_results": results, "retries": retries, "status": int(status), "error_feedback": str(results['error'])}
     
-    return {"sql_results": results}
+    return {"sql_results": results, "status": int(ExecStatus.OK)}
 
-def synthesizer_node(state: AgentState):
-    print("--- [Synthesizer] Finalizing answer... ---")
-    sql_res = state.get("sql_results", {})
+def _compact_rows(columns: List[str], rows: List, max_rows: int = 10, max_chars: int = 300,
+                  truncated: bool = False) -> str:
+    """
+    Renders SQL rows for the synthesizer prompt as a pipe-separated header plus the first
+    rows, within a character budget. A 1x1 result is just the scalar.
+    `truncated` marks rows already capped at fetch time, so the remainder is a lower bound.
+    """
+    if not rows:
+        return "No results"
+    if len(rows) == 1 and len(rows[0]) == 1 and not truncated:
+        return str(rows[0][0])[:max_chars]
     
+    # The header counts against the budget too: keep room for the "more rows" suffix and
+    # cap the header at half of what is left so at least part of the first row fits
+    reserve = len(f"\n... ({len(rows)}+ more rows)") if len(rows) > 1 or truncated else 0
+    budget = max_chars - reserve
+    header = "|".join(columns)
+    if len(header) > budget // 2:
+        header = header[:max(0, budget // 2 - 3)] + "..."
+    buf = io.StringIO()
+    buf.write(header)
+    shown = 0
+    for row in rows[:max_rows]:
+        line = "|".join(map(str, row))
+        if buf.tell() + 1 + len(line) > budget:
+            if shown == 0:
+                # Always show part of the first row rather than only the header
+                buf.write("\n" + line[:max(0, budget - buf.tell() - 4)] + "...")
+                shown = 1
+            break
+        buf.write("\n" + line)
+        shown += 1
+    if shown < len(rows) or truncated:
+        buf.write(f"\n... ({len(rows) - shown}{'+' if truncated else ''} more rows)")
+    return buf.getvalue()
+
+def _synthesize_with_llm(state: AgentState, sql_res: Dict):
+    """Runs the synthesizer LLM and coerces its answer to the format hint. Returns (value, explanation)."""
     # Pass actual document text for RAG questions, keep it short
     docs = state.get("retrieved_docs", [])
     if docs:
@@ -193,11 +321,9 @@ def synthesizer_node(state: AgentState):
     else:
         context_str = ""
     
-    # Format SQL results cleanly
-    sql_rows = sql_res.get("rows", [])
-    sql_result_str = str(sql_rows) if sql_rows else "No results"
-    if len(sql_result_str) > 300:
-        sql_result_str = sql_result_str[:300] + "..."
+    # Format SQL results compactly; the model pays input tokens for every character
+    sql_result_str = _compact_rows(sql_res.get("columns", []), sql_res.get("rows", []),
+                                   truncated=sql_res.get("truncated", False))
     
     pred = synthesizer_module(
         question=state["question"],
@@ -213,11 +339,11 @@ def synthesizer_node(state: AgentState):
     
     try:
         if hint == "int":
-            nums = re.findall(r'\d+', raw_answer)
-            final_val = int(nums[0]) if nums else 0
+            m = _RE_INT.search(raw_answer)
+            final_val = int(m.group()) if m else 0
         elif hint == "float":
-            nums = re.findall(r"[-+]?\d*\.\d+|\d+", raw_answer)
-            final_val = round(float(nums[0]), 2) if nums else 0.0
+            m = _RE_FLOAT.search(raw_answer)
+            final_val = round(float(m.group()), 2) if m else 0.0
         elif "list" in hint or "{" in hint:
              if "{" in raw_answer or "[" in raw_answer:
                 try:
@@ -227,13 +353,6 @@ def synthesizer_node(state: AgentState):
     except:
         pass
     
-    citations = [doc["id"] for doc in state.get("retrieved_docs", [])]
-    if sql_query := state.get("sql_query"):
-        for tbl in ["Orders", "Order Details", "Products", "Customers", "Categories", "Suppliers"]:
-            if tbl in sql_query or f'"{tbl}"' in sql_query: citations.append(tbl)
-            
-    confidence = 1.0 - (0.2 * state.get("retries", 0)) if not sql_res.get("error") else 0.0
-    
     # Extract explanation (field name is 'why' in signature)
     explanation_text = ""
     if hasattr(pred, 'why'):
@@ -243,13 +362,36 @@ def synthesizer_node(state: AgentState):
     elif hasattr(pred, 'explanation'):
         explanation_text = pred.explanation[:200] if pred.explanation else ""
     
+    return final_val, explanation_text
+
+def synthesizer_node(state: AgentState):
+    print("--- [Synthesizer] Finalizing answer... ---")
+    sql_res = state.get("sql_results", {})
+    hint = state["format_hint"]
+    
+    # A single numeric cell already is the answer for int/float questions: skip the LLM
+    sql_rows = sql_res.get("rows", [])
+    scalar = sql_rows[0][0] if len(sql_rows) == 1 and len(sql_rows[0]) == 1 else None
+    if hint in ("int", "float") and isinstance(scalar, (int, float)) and not isinstance(scalar, bool):
+        print("   (Scalar SQL result, answering without LLM)")
+        final_val = int(round(scalar)) if hint == "int" else round(float(scalar), 2)
+        explanation_text = "Direct value from SQL query."
+    else:
+        final_val, explanation_text = _synthesize_with_llm(state, sql_res)
+    
+    citations = {doc["id"] for doc in state.get("retrieved_docs", [])}
+    if sql_query := state.get("sql_query"):
+        citations.update(_RE_TABLES.findall(sql_query))
+            
+    confidence = 1.0 - (0.2 * state.get("retries", 0)) if not sql_res.get("error") else 0.0
+    
     output_obj = {
         "id": state["id"],
         "final_answer": final_val,
         "sql": state.get("sql_query", ""),
         "confidence": round(max(0.0, confidence), 2),
         "explanation": explanation_text,
-        "citations": list(set(citations))
+        "citations": sorted(citations)
     }
     
     return {"final_output": output_obj}
@@ -258,40 +400,38 @@ def synthesizer_node(state: AgentState):
 
 workflow = StateGraph(AgentState)
 
-workflow.add_node("router", router_node)
-workflow.add_node("search_query_generator", search_query_generation_node)
+workflow.add_node("prelude", prelude_node)
 workflow.add_node("retriever", retriever_node)
 workflow.add_node("planner", planner_node) # Planner is back!
 workflow.add_node("sql_generator", sql_generator_node)
 workflow.add_node("executor", executor_node)
 workflow.add_node("synthesizer", synthesizer_node)
 
-workflow.set_entry_point("router")
+workflow.set_entry_point("prelude")
 
-# Router -> (Search Query Generator OR SQL Generator)
-def route_after_router(state):
-    # RAG and Hybrid need docs, so they go to Search Query -> Retriever
-    if state["route"] in ["rag", "hybrid"]:
-        return "search_query_generator"
+# Prelude (Router + Search Query Generator) -> (Retriever OR SQL Generator)
+def route_after_prelude(state):
+    # RAG and Hybrid need docs, so they go to the Retriever
+    if state["route"] != Route.SQL:
+        return "retriever"
     # Pure SQL skips retrieval AND planner
     return "sql_generator"
 
 workflow.add_conditional_edges(
-    "router",
-    route_after_router,
+    "prelude",
+    route_after_prelude,
     {
-        "search_query_generator": "search_query_generator",
+        "retriever": "retriever",
         "sql_generator": "sql_generator"
     }
 )
 
-workflow.add_edge("search_query_generator", "retriever")
 workflow.add_edge("retriever", "planner")
 
 # Planner -> (Synthesizer OR SQL Generator)
 def route_after_planner(state):
     # RAG skips SQL
-    if state["route"] == "rag":
+    if state["route"] == Route.RAG:
         print("--- [Graph] Route is RAG, skipping SQL... ---")
         return "synthesizer"
     return "sql_generator"
@@ -309,13 +449,12 @@ workflow.add_edge("sql_generator", "executor")
 
 # Executor -> (Retry OR Synthesizer)
 def route_after_executor(state):
-    res = state.get("sql_results", {})
-    if res.get("error"):
-        if state.get("retries", 0) <= 2:
-            print(f"!!! Triggering Repair Loop ({state.get('retries', 0)}/2) !!!")
-            return "retry"
-        else:
-            print("!!! Max retries reached. Moving to synthesis.")
+    status = state["status"]
+    if status == ExecStatus.RETRY:
+        print(f"!!! Triggering Repair Loop ({state['retries']}/{MAX_RETRIES}) !!!")
+        return "retry"
+    if status == ExecStatus.GIVE_UP:
+        print("!!! Max retries reached. Moving to synthesis.")
     return "finalize"
 
 workflow.add_conditional_edges(
@@ -329,5 +468,42 @@ workflow.add_conditional_edges(
 
 workflow.add_edge("synthesizer", END)
 
-memory = MemorySaver()
-app = workflow.compile(checkpointer=memory)
\ No newline at end of file
+# Checkpoints persist across runs, so an interrupted batch can resume a question mid-graph
+CHECKPOINT_DB_PATH = "agent/state.db"
+memory = None if GRAPH_VIZ_ONLY else SqliteSaver(sqlite3.connect(CHECKPOINT_DB_PATH, check_same_thread=False))
+app = workflow.compile(checkpointer=memory)
+
+# --- 5. BATCH EXECUTION ---
+
+def make_initial_state(q_id: str, question: str, format_hint: str = "str") -> Dict:
+    return {
+        "id": q_id,
+        "question": question,
+        "format_hint": format_hint,
+        "retries": 0,
+        "sql_results": {},
+        "retrieved_docs": []
+    }
+
+async def arun(q_id: str, question: str, format_hint: str = "str") -> Dict:
+    """Runs one question from scratch and returns the final graph state."""
+    config = {"configurable": {"thread_id": str(q_id)}}
+    # The nodes and SqliteSaver are synchronous, so each run gets its own worker thread
+    memory.delete_thread(str(q_id))
+    return await asyncio.to_thread(
+        app.invoke, make_initial_state(q_id, question, format_hint), config=config, recursion_limit=20
+    )
+
+async def run_many(questions: List[Dict], concurrency: int = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))) -> List:
+    """
+    Runs questions ({"id", "question", "format_hint"}) concurrently, at most `concurrency` at a
+    time to match Ollama's parallel slots (start the server with OLLAMA_NUM_PARALLEL set).
+    Results are in input order; a failed question yields its exception.
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def limited(q: Dict):
+        async with sem:
+            return await arun(q["id"], q["question"], q.get("format_hint", "str"))
+
+    return await asyncio.gather(*(limited(q) for q in questions), return_exceptions=True)
@@ -0,0 +1,314 @@
+"""
+Response cache for the DSPy modules used by the graph.
+
+Every node call is a full round-trip to the local Ollama model, so repeated or
+near-identical questions (eval reruns, retries, paraphrases) are answered from here.
+"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+import dspy
+import numpy as np
+from rapidfuzz import fuzz, process
+
+from .ollama_client import OLLAMA_API_BASE, OLLAMA_MODEL
+
+CACHE_DB_PATH = "agent/llm_cache.db"
+EMBED_MODEL = "ollama/nomic-embed-text"
+
+SIMILARITY_THRESHOLD = 0.92  # cosine similarity for question-to-question hits
+TTL_SECONDS = 7 * 24 * 3600
+MAX_ENTRIES = 256  # per module, LRU-evicted
+FUZZY_CUTOFF = 95  # edit-distance ratio (0-100) for typo/punctuation-level variants
+
+
+_WS = re.compile(r'\s+')
+# Signed/decimal numbers are matched first so their '-', '.' and ',' survive: "1.5" != "15"
+_NUMBER = re.compile(r'[-+]?\d[\d.,]*\d|[-+]?\d')
+# Only punctuation that cannot change a question's meaning is dropped; operators and units
+# (<, >, =, !, %, $, ...) stay, so "freight > 100" and "freight < 100" get different keys
+_PUNCT = re.compile(rf'({_NUMBER.pattern})|[?.,;:\'"`]')
+
+
+def normalize_question(q: str) -> str:
+    """Cache-key form of a question: lowercase, no sentence punctuation/quotes outside numbers, single spaces. Never sent to the LLM."""
+    return _WS.sub(' ', _PUNCT.sub(lambda m: m.group(1) or '', q.lower())).strip()
+
+
+def _digest(payload: Dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _fingerprint(module, model: str) -> str:
+    """Short hash of what shapes a module's output besides its inputs: model, signature, LM config."""
+    parts = {"model": model, "config": getattr(module, "config", {})}
+    signature = getattr(module, "signature", None)
+    if signature is not None:
+        parts["instructions"] = signature.instructions
+        parts["fields"] = list(signature.fields)
+    return _digest(parts)[:12]
+
+
+class _CacheStore:
+    """Shared sqlite persistence so cache entries survive process restarts."""
+
+    def __init__(self, db_path: str = CACHE_DB_PATH):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, module TEXT, pred TEXT, ts REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_cache ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, module TEXT, context_key TEXT, "
+                "embedding BLOB, pred TEXT, ts REAL)"
+            )
+            self.conn.commit()
+
+    def load_exact(self, module: str, min_ts: float) -> List[tuple]:
+        with self.lock:
+            self.conn.execute("DELETE FROM llm_cache WHERE ts < ?", (min_ts,))
+            self.conn.commit()
+            return self.conn.execute(
+                "SELECT key, pred, ts FROM llm_cache WHERE module = ? ORDER BY ts", (module,)
+            ).fetchall()
+
+    def put_exact(self, key: str, module: str, pred_json: str, ts: float):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, module, pred, ts) VALUES (?, ?, ?, ?)",
+                (key, module, pred_json, ts),
+            )
+            self.conn.commit()
+
+    def delete_exact(self, key: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def load(self, module: str, min_ts: float) -> List[tuple]:
+        with self.lock:
+            self.conn.execute("DELETE FROM semantic_cache WHERE ts < ?", (min_ts,))
+            self.conn.commit()
+            return self.conn.execute(
+                "SELECT id, context_key, embedding, pred, ts FROM semantic_cache WHERE module = ? ORDER BY ts",
+                (module,),
+            ).fetchall()
+
+    def insert(self, module: str, context_key: str, vec: np.ndarray, pred_json: str, ts: float) -> int:
+        with self.lock:
+            cur = self.conn.execute(
+                "INSERT INTO semantic_cache (module, context_key, embedding, pred, ts) VALUES (?, ?, ?, ?, ?)",
+                (module, context_key, vec.astype(np.float32).tobytes(), pred_json, ts),
+            )
+            self.conn.commit()
+            return cur.lastrowid
+
+    def delete(self, row_id: int):
+        with self.lock:
+            self.conn.execute("DELETE FROM semantic_cache WHERE id = ?", (row_id,))
+            self.conn.commit()
+
+
+_store: Optional[_CacheStore] = None
+_embedder = None
+_embed_disabled = False
+_init_lock = threading.Lock()
+
+
+def _get_store() -> _CacheStore:
+    global _store
+    with _init_lock:
+        if _store is None:
+            _store = _CacheStore()
+    return _store
+
+
+def _embed(text: str) -> Optional[np.ndarray]:
+    """Returns an L2-normalized embedding, or None if the embedding model is unavailable."""
+    global _embedder, _embed_disabled
+    if _embed_disabled:
+        return None
+    try:
+        if _embedder is None:
+            _embedder = dspy.Embedder(EMBED_MODEL, api_base=OLLAMA_API_BASE)
+        vec = np.asarray(_embedder([text])[0], dtype=np.float32)
+    except Exception as e:
+        print(f"   (Semantic cache disabled, embedding failed: {e})")
+        _embed_disabled = True
+        return None
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+class CachedModule:
+    """
+    Wraps a DSPy module with a three-tier cache, cheapest first.
+
+    1. Exact match: SHA-256 of the canonicalized inputs, an O(1) dict probe.
+    2. Fuzzy (opt-in, `fuzzy=True`): Levenshtein ratio >= FUZZY_CUTOFF against recently seen
+       questions with identical other inputs and identical numbers; catches typos without
+       paying for an embedding. A one-word edit can flip the meaning (maximum/minimum,
+       before/after), so enable it only where near-duplicate questions have interchangeable
+       outputs (router, query_gen), never for SQL or answers.
+    3. Semantic (opt-in, `semantic=True`): the `question` input is embedded and compared
+       against earlier calls whose other inputs and question numbers were identical; if the
+       best cosine similarity is >= the threshold, the stored Prediction is returned and the
+       LLM is skipped. Opposite wordings (max/min, before/after) embed far above the threshold,
+       so like the fuzzy tier it is only for router and query_gen.
+
+    Modules that write SQL or answers (sql_gen, planner, synthesizer) are exact-match only.
+
+    `static_fields` maps inputs that never change (e.g. the DB schema) to a precomputed
+    digest, so their multi-KB values are not re-serialized into every key.
+
+    Entries are stored under `name` plus a fingerprint of the model, the signature's
+    instructions and fields, and the module's LM config, so editing a signature or switching
+    models starts a fresh namespace instead of serving stale predictions.
+    """
+
+    def __init__(self, name: str, module, semantic_field: str = "question",
+                 static_fields: Optional[Dict[str, str]] = None,
+                 threshold: float = SIMILARITY_THRESHOLD, ttl: float = TTL_SECONDS,
+                 max_entries: int = MAX_ENTRIES, model: str = OLLAMA_MODEL, fuzzy: bool = False,
+                 semantic: bool = False):
+        self.name = name
+        self.fuzzy = fuzzy
+        self.semantic = semantic
+        self.namespace = f"{name}:{_fingerprint(module, model)}"
+        self.module = module
+        self.semantic_field = semantic_field
+        self.static_fields = static_fields or {}
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # id -> (context_key, embedding, prediction dict, ts); ordered oldest -> most recently used
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._exact: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (prediction dict, ts), LRU order
+        self._recent: deque = deque(maxlen=max_entries)  # (context_key, question, prediction dict, ts)
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        min_ts = time.time() - self.ttl
+        for key, pred_json, ts in _get_store().load_exact(self.namespace, min_ts):
+            self._exact[key] = (json.loads(pred_json), ts)
+        semantic_rows = _get_store().load(self.namespace, min_ts) if self.semantic else []
+        for row_id, context_key, blob, pred_json, ts in semantic_rows:
+            self._entries[row_id] = (context_key, np.frombuffer(blob, dtype=np.float32), json.loads(pred_json), ts)
+        while len(self._exact) > self.max_entries:
+            _get_store().delete_exact(self._exact.popitem(last=False)[0])
+        while len(self._entries) > self.max_entries:
+            _get_store().delete(self._entries.popitem(last=False)[0])
+        self._loaded = True
+
+    def _key_inputs(self, kwargs: Dict) -> Dict:
+        key_inputs = {k: self.static_fields.get(k, v) for k, v in kwargs.items()}
+        if self.semantic_field in key_inputs:
+            key_inputs[self.semantic_field] = normalize_question(str(key_inputs[self.semantic_field]))
+        return key_inputs
+
+    def _lookup_exact(self, key: str) -> Optional[dspy.Prediction]:
+        with self._lock:
+            self._load()
+            entry = self._exact.get(key)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                return None
+            self._exact.move_to_end(key)
+            return dspy.Prediction(**entry[0])
+
+    def _put_exact(self, key: str, pred_dict: Dict, pred_json: str, ts: float):
+        store = _get_store()
+        store.put_exact(key, self.namespace, pred_json, ts)
+        with self._lock:
+            self._exact[key] = (pred_dict, ts)
+            self._exact.move_to_end(key)
+            while len(self._exact) > self.max_entries:
+                store.delete_exact(self._exact.popitem(last=False)[0])
+
+    def _lookup_fuzzy(self, context_key: str, query_text: str) -> Optional[dspy.Prediction]:
+        now = time.time()
+        # Years, top-N and thresholds are exactly what differs between analytics questions,
+        # and they barely move the edit ratio: only questions with the same numbers qualify
+        numbers = _NUMBER.findall(query_text)
+        with self._lock:
+            candidates = [e for e in self._recent if e[0] == context_key and now - e[3] <= self.ttl
+                          and _NUMBER.findall(e[1]) == numbers]
+        if not candidates:
+            return None
+        match = process.extractOne(query_text, [e[1] for e in candidates],
+                                   scorer=fuzz.ratio, score_cutoff=FUZZY_CUTOFF)
+        return dspy.Prediction(**candidates[match[2]][2]) if match else None
+
+    def _lookup(self, context_key: str, vec: np.ndarray) -> Optional[dspy.Prediction]:
+        now = time.time()
+        with self._lock:
+            self._load()
+            candidates = [(row_id, e) for row_id, e in self._entries.items()
+                          if e[0] == context_key and now - e[3] <= self.ttl]
+            if not candidates:
+                return None
+            # Flat inner-product search; vectors are normalized so this is cosine similarity
+            sims = np.stack([e[1] for _, e in candidates]) @ vec
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            row_id, entry = candidates[best]
+            self._entries.move_to_end(row_id)
+            return dspy.Prediction(**entry[2])
+
+    def _put(self, context_key: str, vec: np.ndarray, pred_dict: Dict, pred_json: str, ts: float):
+        store = _get_store()
+        row_id = store.insert(self.namespace, context_key, vec, pred_json, ts)
+        with self._lock:
+            self._entries[row_id] = (context_key, vec, pred_dict, ts)
+            while len(self._entries) > self.max_entries:
+                store.delete(self._entries.popitem(last=False)[0])
+
+    def __call__(self, **kwargs) -> dspy.Prediction:
+        key_inputs = self._key_inputs(kwargs)
+        exact_key = _digest({"module": self.namespace, "inputs": key_inputs})
+        cached = self._lookup_exact(exact_key)
+        if cached is not None:
+            print(f"   (Cache hit: {self.name}, exact)")
+            return cached
+
+        query_text = key_inputs.get(self.semantic_field, "")
+        context_key = _digest({k: v for k, v in key_inputs.items() if k != self.semantic_field})
+
+        if self.fuzzy and query_text:
+            cached = self._lookup_fuzzy(context_key, query_text)
+            if cached is not None:
+                print(f"   (Cache hit: {self.name}, fuzzy)")
+                return cached
+
+        # Embeddings of questions differing only in a year or top-N are nearly identical, so the
+        # semantic tier only compares against entries with the same numbers
+        semantic_key = _digest({"context": context_key, "numbers": _NUMBER.findall(query_text)})
+        vec = _embed(query_text) if self.semantic and query_text else None
+        if vec is not None:
+            cached = self._lookup(semantic_key, vec)
+            if cached is not None:
+                print(f"   (Cache hit: {self.name}, semantic)")
+                return cached
+
+        pred = self.module(**kwargs)
+        pred_dict = pred.toDict()
+        pred_json = json.dumps(pred_dict, default=str)
+        ts = time.time()
+        self._put_exact(exact_key, pred_dict, pred_json, ts)
+        if self.fuzzy:
+            with self._lock:
+                self._recent.append((context_key, query_text, pred_dict, ts))
+        if vec is not None:
+            self._put(semantic_key, vec, pred_dict, pred_json, ts)
+        return pred
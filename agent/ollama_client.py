@@ -0,0 +1,88 @@
+"""
+Minimal client for the local Ollama HTTP API.
+
+Used where DSPy's generic prompt formatting is overkill, e.g. the router, whose
+output is one of three fixed labels.
+"""
+import json
+import os
+from typing import Dict, List, Optional
+
+import dspy
+import httpx
+
+from .dspy_signatures import ClassifyQuestion
+
+OLLAMA_API_BASE = "http://localhost:11434"
+OLLAMA_MODEL = "phi3.5:3.8b-mini-instruct-q4_K_M"
+
+# Keep the model resident between questions (a reload costs seconds), and size the context
+# to what our prompts need. Every caller must use the same num_ctx, otherwise Ollama reloads.
+KEEP_ALIVE = "30m"
+NUM_CTX = 2048
+
+# One keep-alive connection pool shared by every caller (thread-safe); sized to match
+# the number of requests Ollama can serve in parallel plus headroom
+_client = httpx.Client(
+    base_url=OLLAMA_API_BASE,
+    limits=httpx.Limits(max_connections=8, max_keepalive_connections=8),
+)
+
+
+def generate(prompt: str, format: Optional[Dict] = None, options: Optional[Dict] = None,
+             model: str = OLLAMA_MODEL, timeout: float = 120.0) -> str:
+    """Calls /api/generate (non-streaming) and returns the raw response text."""
+    payload = {"model": model, "prompt": prompt, "stream": False, "keep_alive": KEEP_ALIVE,
+               "options": {"num_ctx": NUM_CTX, **(options or {})}}
+    if format is not None:
+        payload["format"] = format
+
+    resp = _client.post("/api/generate", json=payload, timeout=timeout)
+    resp.raise_for_status()
+    return resp.json()["response"]
+
+
+def warm_up(model: str = OLLAMA_MODEL):
+    """Loads the model into memory ahead of the first real request (a prompt-less generate call)."""
+    try:
+        _client.post("/api/generate", json={"model": model, "keep_alive": KEEP_ALIVE,
+                                            "options": {"num_ctx": NUM_CTX}}, timeout=300.0)
+    except httpx.HTTPError as e:
+        print(f"   (Model warm-up failed: {e})")
+
+
+class ConstrainedRouter(dspy.Module):
+    """
+    Router that decodes under a JSON schema restricting `label` to rag|sql|hybrid.
+    Ollama enforces the schema during sampling, so generation stops after a few tokens
+    and the output never needs free-text parsing.
+    """
+
+    LABELS = ("rag", "sql", "hybrid")
+    LABEL_SCHEMA = {
+        "type": "object",
+        "properties": {"label": {"type": "string", "enum": list(LABELS)}},
+        "required": ["label"],
+    }
+
+    def __init__(self, demos: Optional[List[Dict]] = None):
+        super().__init__()
+        # Exposed like dspy.Predict's, so the LLM cache fingerprints the router's instructions/fields
+        self.signature = ClassifyQuestion
+        self.instructions = ClassifyQuestion.instructions
+        # Few-shot block is fixed per process, so render it once
+        self.demo_block = "".join(f"Question: {d['question']}\nLabel: {d['label']}\n\n" for d in demos or [])
+
+    @classmethod
+    def from_saved(cls, path: str) -> "ConstrainedRouter":
+        """Builds the router from the demos of a saved (frozen) DSPy program; zero-shot if absent."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            demos = json.load(f).get("demos", [])
+        return cls([d for d in demos if d.get("label") in cls.LABELS])
+
+    def forward(self, question: str) -> dspy.Prediction:
+        prompt = f"{self.instructions}\n\n{self.demo_block}Question: {question}\nLabel:"
+        raw = generate(prompt, format=self.LABEL_SCHEMA, options={"temperature": 0, "num_predict": 16})
+        return dspy.Prediction(label=json.loads(raw)["label"])
@@ -1,43 +1,207 @@
 import os
 import re
-from typing import List, Dict
-from rank_bm25 import BM25Okapi
+import glob
+import mmap
+import json
+import string
+import hashlib
+import zipfile
+from collections import Counter
+from functools import lru_cache
+from typing import List, Dict, Tuple
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional; the NumPy kernel below computes the same scores
+    njit = None
+
+# BM25 Okapi parameters (same defaults as rank_bm25.BM25Okapi)
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25  # floor for negative IDFs, as a fraction of the average IDF
+
+# Bump when chunking/tokenization/index layout changes so stale on-disk indexes are rebuilt
+INDEX_VERSION = 4
+
+# One analyzer for both index and queries, so their tokens always agree: ASCII lowercase via a
+# translate table, then alphanumeric runs (punctuation never sticks to a term, e.g. "beverages?")
+_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_TOK_RE = re.compile(r"[a-z0-9]+")
+
+def _tokenize(text: str) -> List[str]:
+    return _TOK_RE.findall(text.translate(_LOWER))
+
+def _accumulate_numpy(scores: np.ndarray, doc_ids: np.ndarray, weights: np.ndarray, n: np.float32):
+    """scores[d] += n * precomputed BM25 weight for one posting list (doc ids are unique)."""
+    scores[doc_ids] += weights if n == 1 else n * weights
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _accumulate(scores, doc_ids, weights, n):
+        # Single scatter-add pass, no temporaries. Serial on purpose: postings here are short, and
+        # thread launch for prange would cost more than the loop itself
+        for i in range(doc_ids.shape[0]):
+            scores[doc_ids[i]] += n * weights[i]
+
+    # Compile (or load from the on-disk cache) now rather than on the first query
+    _accumulate(np.zeros(1, dtype=np.float32), np.zeros(1, dtype=np.int32),
+                np.ones(1, dtype=np.float32), np.float32(1.0))
+else:
+    _accumulate = _accumulate_numpy
+
+def _decode(raw: bytes) -> str:
+    """UTF-8 decode with the same newline translation as reading the file in text mode."""
+    return raw.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
 
 class LocalRetriever:
+    # Bytes pattern: runs directly over the memory-mapped file
+    _HEADER_RE = re.compile(rb'(?m)^## (.*)$')
+
     def __init__(self, docs_path: str = "docs/"):
         self.docs_path = docs_path
         self.chunks: List[Dict] = []
-        self.bm25 = None
+        # Terms are interned to dense int32 ids; everything below is indexed by term id
+        self.vocab: Dict[str, int] = {}
+        # Structure-of-arrays BM25 index: term id -> (doc ids int32, BM25 weights float32),
+        # views into flat CSR arrays (offsets / doc_ids / weights). Weights are the full
+        # idf * tf-saturation contribution, computed once at build time (eager scoring)
+        self.postings: List[Tuple[np.ndarray, np.ndarray]] = []
         self._build_index()
+        # The index is static after build, so results depend only on the query term ids
+        self._ranked = lru_cache(maxsize=4096)(self._rank)
+
+    def _docs_signature(self) -> str:
+        """Hash of the .md file names, sizes and mtimes (plus INDEX_VERSION)."""
+        entries = sorted(
+            (name, os.path.getsize(os.path.join(self.docs_path, name)), os.path.getmtime(os.path.join(self.docs_path, name)))
+            for name in os.listdir(self.docs_path) if name.endswith(".md")
+        )
+        return hashlib.sha1(json.dumps([INDEX_VERSION, entries]).encode("utf-8")).hexdigest()[:16]
 
     def _build_index(self):
-        """Reads all .md files, chunks them, and builds BM25 index."""
+        """Loads the persisted index if the docs are unchanged; otherwise reads all .md files, chunks them, and builds BM25 index."""
+        cache_path = os.path.join(self.docs_path, f".bm25_cache_{self._docs_signature()}.npz")
+        if os.path.exists(cache_path):
+            try:
+                self._load_index(cache_path)
+                return
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+                # Truncated/corrupt file: rebuild, and the save below replaces it
+                print(f"(Could not load BM25 index {cache_path}: {e}; rebuilding)")
+                self.chunks, self.vocab, self.postings = [], {}, []
+
         for filename in os.listdir(self.docs_path):
             if filename.endswith(".md"):
                 filepath = os.path.join(self.docs_path, filename)
-                with open(filepath, "r", encoding="utf-8") as f:
-                    content = f.read()
-                    self._chunk_file(filename, content)
+                if os.path.getsize(filepath) == 0:
+                    continue  # mmap cannot map empty files, and they yield no chunks anyway
+                # Map instead of read(): headers are found on the raw bytes and only the
+                # section slices are decoded
+                with open(filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    self._chunk_file(filename, mm)
         
-        corpus_tokens = [chunk["text"].lower().split() for chunk in self.chunks]
-        if corpus_tokens:
-            self.bm25 = BM25Okapi(corpus_tokens)
+        # Each chunk becomes an int32 array of term ids; ids are assigned in first-seen order
+        vocab = self.vocab
+        doc_tokens = [np.fromiter((vocab.setdefault(tok, len(vocab)) for tok in _tokenize(chunk["text"])),
+                                  dtype=np.int32) for chunk in self.chunks]
+        if doc_tokens:
+            self._build_bm25(doc_tokens)
+            self._save_index(cache_path)
+
+    def _save_index(self, cache_path: str):
+        """
+        Writes the CSR postings plus JSON metadata (vocab order = term ids) into one .npz file.
+        The file is written under a per-process temp name and renamed into place, so readers
+        (including a concurrently starting process) never see a partial index.
+        """
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            for stale in glob.glob(os.path.join(self.docs_path, ".bm25_cache_*.npz")):
+                if stale != cache_path:
+                    os.remove(stale)
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    meta=np.array(json.dumps({"terms": list(self.vocab), "chunks": self.chunks})),
+                    offsets=self.offsets,
+                    doc_ids=self.doc_ids,
+                    weights=self.weights,
+                )
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"(Could not persist BM25 index: {e})")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-    def _chunk_file(self, filename: str, content: str):
-        """Splits file into chunks, robustly handling different formats."""
+    def _load_index(self, cache_path: str):
+        # Indexing an NpzFile reads the array into memory, so the file can be closed right after
+        with np.load(cache_path) as data:
+            meta = json.loads(str(data["meta"]))
+            offsets, doc_ids, weights = data["offsets"], data["doc_ids"], data["weights"]
+        self.chunks = meta["chunks"]
+        self.vocab = {term: tid for tid, term in enumerate(meta["terms"])}
+        self._set_postings(offsets, doc_ids, weights)
+
+    def _set_postings(self, offsets: np.ndarray, doc_ids: np.ndarray, weights: np.ndarray):
+        self.offsets, self.doc_ids, self.weights = offsets, doc_ids, weights
+        self.postings = [(doc_ids[offsets[t]:offsets[t + 1]], weights[offsets[t]:offsets[t + 1]])
+                         for t in range(len(offsets) - 1)]
+
+    def _build_bm25(self, doc_tokens: List[np.ndarray]):
+        """Builds contiguous float32 CSR postings holding each (term, chunk) BM25 contribution."""
+        n_docs = len(doc_tokens)
+        n_terms = len(self.vocab)
+        doc_lens = np.array([len(tokens) for tokens in doc_tokens], dtype=np.float32)
+        doc_norm = (1 - BM25_B + BM25_B * doc_lens / doc_lens.mean()).astype(np.float32)
+
+        # (term id, doc id, tf) triples, then a stable sort by term id groups them into postings
+        # with doc ids ascending, i.e. CSR order
+        per_doc = [np.unique(tokens, return_counts=True) for tokens in doc_tokens]
+        term_ids = np.concatenate([tids for tids, _ in per_doc])
+        doc_ids = np.concatenate([np.full(len(tids), d, dtype=np.int32) for d, (tids, _) in enumerate(per_doc)])
+        tfs = np.concatenate([counts for _, counts in per_doc]).astype(np.float32)
+        order = np.argsort(term_ids, kind="stable")
+        term_ids, doc_ids, tfs = term_ids[order], doc_ids[order], tfs[order]
+
+        dfs = np.bincount(term_ids, minlength=n_terms)
+        offsets = np.zeros(n_terms + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(dfs)
+        idfs = np.log(n_docs - dfs + 0.5) - np.log(dfs + 0.5)
+        idfs[idfs < 0] = BM25_EPSILON * idfs.mean()
+
+        # The corpus is static, so the whole BM25 formula is evaluated here once per posting;
+        # a query then only sums weights
+        weights = idfs.astype(np.float32)[term_ids] * tfs * (BM25_K1 + 1) / (tfs + BM25_K1 * doc_norm[doc_ids])
+        self._set_postings(offsets, doc_ids, weights.astype(np.float32))
+
+    def _score(self, query_tids: Tuple[int, ...]) -> np.ndarray:
+        """
+        BM25 scores of every chunk for the query (repeated query terms count repeatedly).
+        No dynamic pruning (MaxScore/WAND): its per-term threshold check over all chunks costs
+        more than the short postings it would skip, so every posting is simply summed.
+        """
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term, n in Counter(query_tids).items():
+            doc_ids, weights = self.postings[term]
+            _accumulate(scores, doc_ids, weights, np.float32(n))
+        return scores
+
+    def _chunk_file(self, filename: str, data: bytes):
+        """Splits file (UTF-8 bytes or an mmap of them) into chunks, robustly handling different formats."""
         current_chunk_idx = 0
         
-        # Split by markdown headers (##)
-        sections = re.split(r'(^|\n)## ', content)
+        # Locate markdown headers (##) and slice sections straight out of `data`. Slice bounds sit
+        # on ASCII '#'/newline bytes, so each slice decodes on its own
+        headers = list(self._HEADER_RE.finditer(data))
         
         # If the file has ## sections, process them
-        if len(sections) > 1:
-            main_title = sections[0].strip().replace("# ", "")
-            for section in sections[1:]:
-                if not section.strip(): continue
-                lines = section.split('\n')
-                section_title = lines[0].strip()
-                body = '\n'.join(lines[1:]).strip()
+        if headers:
+            main_title = _decode(data[:headers[0].start()]).strip().replace("# ", "")
+            ends = [h.start() for h in headers[1:]] + [len(data)]
+            for header, end in zip(headers, ends):
+                section_title = _decode(header.group(1)).strip()
+                body = _decode(data[header.end():end]).strip()
                 if not body: continue
                 
                 full_text = f"Source: {filename}\nContext: {main_title} > {section_title}\nContent:\n{body}"
@@ -47,7 +211,7 @@ class LocalRetriever:
         # --- ROBUST FALLBACK ---
         # If no ## sections, treat each list item as a chunk
         else:
-            lines = content.split('\n')
+            lines = _decode(data[:]).split('\n')
             main_title = lines[0].strip().replace("# ", "")
             for line in lines[1:]:
                 # If a line is a list item, it's a good chunk
@@ -57,21 +221,42 @@ class LocalRetriever:
                     self.chunks.append({"id": chunk_id, "text": full_text, "source": filename})
                     current_chunk_idx += 1
 
+    def _rank(self, query_tids: Tuple[int, ...], top_k: int) -> Tuple[Tuple[int, float], ...]:
+        """Returns (chunk index, score) pairs for the top_k positive-scoring chunks."""
+        if top_k <= 0: return ()
+        scores = self._score(query_tids)
+        n_docs = len(scores)
+        if top_k < n_docs:
+            # Only chunks at or above the k-th best score (ties included) can make the cut
+            kth = scores[np.argpartition(scores, n_docs - top_k)[n_docs - top_k]]
+            candidates = np.flatnonzero(scores >= max(kth, np.float32(0.0)))
+        else:
+            candidates = np.flatnonzero(scores)
+        candidates = candidates[scores[candidates] > 0.0]
+        # Stable sort of the small candidate set keeps lower chunk indices first on ties
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")[:top_k]]
+        return tuple((int(i), float(scores[i])) for i in candidates)
+
     def search(self, query: str, top_k: int = 3) -> List[Dict]:
         """Returns top_k chunks with scores."""
-        if not self.bm25: return []
-        tokenized_query = query.lower().split()
-        scores = self.bm25.get_scores(tokenized_query)
-        
-        ranked_chunks = []
-        for i, score in enumerate(scores):
-            if score > 0.0: 
-                chunk_data = self.chunks[i].copy()
-                chunk_data["score"] = float(score)
-                ranked_chunks.append(chunk_data)
-        
-        ranked_chunks.sort(key=lambda x: x["score"], reverse=True)
-        return ranked_chunks[:top_k]
+        if not self.postings: return []
+        # Out-of-vocabulary tokens cannot score, so they are dropped while mapping to ids
+        vocab = self.vocab
+        query_tids = tuple(vocab[t] for t in _tokenize(query) if t in vocab)
+        return [{**self.chunks[i], "score": score} for i, score in self._ranked(query_tids, top_k)]
+
+    def search_many(self, queries: List[str], top_k: int = 3) -> List[List[Dict]]:
+        """Batch variant of `search`; duplicate queries in the batch are scored once."""
+        results: Dict[str, List[Dict]] = {}
+        for query in queries:
+            if query not in results:
+                results[query] = self.search(query, top_k)
+        return [[dict(chunk) for chunk in results[query]] for query in queries]
+
+@lru_cache(maxsize=None)
+def get_retriever(docs_path: str = "docs/") -> LocalRetriever:
+    """Shared retriever per docs directory, so the index is built or loaded once per process."""
+    return LocalRetriever(docs_path)
 
 # --- Quick Test ---
 if __name__ == "__main__":
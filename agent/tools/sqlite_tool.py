@@ -1,76 +1,160 @@
+import os
+import atexit
 import sqlite3
+import threading
 from typing import Dict, List, Tuple, Optional, Any
 
+# Main Northwind tables used by the assignment
+DEFAULT_TABLES = ["Orders", "Order Details", "Products", "Customers", "Categories", "Suppliers"]
+
+# Contact/address/media columns that no analytics question needs; dropped from the compact schema
+VERBOSE_COLUMNS = {
+    "ContactTitle", "Address", "PostalCode", "Phone", "Fax", "HomePage", "Picture",
+    "ShipAddress", "ShipPostalCode",
+}
+
+# Applied once to the shared connection: memory-map up to 256 MB of the DB, 64 MB page cache,
+# in-memory temp tables, and reject writes from generated SQL
+CONNECTION_PRAGMAS = [
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA query_only=1",
+]
+
 class SQLiteTool:
     def __init__(self, db_path: str = "data/northwind.sqlite"):
         self.db_path = db_path
+        # The schema is static for the lifetime of a run, so introspect each variant once
+        self._schema_cache: Dict[Tuple[Tuple[str, ...], bool], str] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def close(self):
+        """Closes the shared connection (registered with atexit); it reopens lazily if used again."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Opens the shared connection on first use; callers must hold self._lock."""
+        if self._conn is None:
+            # cached_statements keeps compiled statements for SQL repeated across retries/runs
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                         isolation_level=None, cached_statements=128)
+            for pragma in CONNECTION_PRAGMAS:
+                self._conn.execute(pragma)
+        return self._conn
+
+    def prefetch(self):
+        """
+        Hints the OS to read the database file into the page cache (POSIX_FADV_WILLNEED).
+        Cheap and non-blocking; meant to run while an LLM call is in flight so the
+        executor later hits RAM instead of disk.
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            fd = os.open(self.db_path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
 
-    def get_schema(self, table_names: Optional[List[str]] = None) -> str:
+    def get_schema(self, table_names: Optional[List[str]] = None, compact: bool = False) -> str:
         """
         Returns a markdown-formatted string of the database schema.
         This is crucial for the LLM to understand table structures.
+        With compact=True, each table is one line, e.g. `"Order Details"(OrderID INTEGER, ...)`,
+        and VERBOSE_COLUMNS are dropped to shorten the prompt.
+        Results are memoized per (tables, compact).
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
         # If no specific tables requested, get the main ones relevant to the assignment
-        if not table_names:
-            table_names = ["Orders", "Order Details", "Products", "Customers", "Categories", "Suppliers"]
+        key = (tuple(table_names or DEFAULT_TABLES), compact)
+        if key not in self._schema_cache:
+            self._schema_cache[key] = self._build_schema(*key)
+        return self._schema_cache[key]
+
+    def _build_schema(self, table_names: Tuple[str, ...], compact: bool) -> str:
+        # One round-trip for all tables: the table-valued pragma_table_info() joined against
+        # sqlite_master, with names bound as parameters rather than formatted into the SQL
+        placeholders = ", ".join("?" * len(table_names))
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT m.name, p.name, p.type FROM sqlite_master AS m, pragma_table_info(m.name) AS p "
+                f"WHERE m.type = 'table' AND m.name IN ({placeholders}) ORDER BY m.name, p.cid",
+                table_names,
+            ).fetchall()
+
+        columns_by_table: Dict[str, List[Tuple[str, str]]] = {}
+        for table, col_name, col_type in rows:
+            columns_by_table.setdefault(table, []).append((col_name, col_type))
 
         schema_str = []
-        
+        # Keep the requested table order; missing tables are skipped
         for table in table_names:
-            # Check if table exists
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
-            if not cursor.fetchone():
+            columns = columns_by_table.get(table)
+            if not columns:
                 continue
 
-            # Get column info using PRAGMA
-            cursor.execute(f"PRAGMA table_info('{table}')")
-            columns = cursor.fetchall()
-            
-            # Format: TableName(ColumnName Type, ColumnName Type, ...)
-            col_strs = [f"{col[1]} {col[2]}" for col in columns]
-            schema_str.append(f"Table: {table}\nColumns: {', '.join(col_strs)}")
+            if compact:
+                # Format: TableName(ColumnName Type, ...) with names containing spaces quoted
+                col_strs = [f"{name} {col_type}" for name, col_type in columns if name not in VERBOSE_COLUMNS]
+                name = f'"{table}"' if " " in table else table
+                schema_str.append(f"{name}({', '.join(col_strs)})")
+            else:
+                col_strs = [f"{name} {col_type}" for name, col_type in columns]
+                schema_str.append(f"Table: {table}\nColumns: {', '.join(col_strs)}")
 
-        conn.close()
-        return "\n\n".join(schema_str)
+        return "\n".join(schema_str) if compact else "\n\n".join(schema_str)
 
-    def execute_sql(self, sql: str) -> Dict[str, Any]:
+    def execute_sql(self, sql: str, max_rows: Optional[int] = None) -> Dict[str, Any]:
         """
         Executes a SQL query and returns the results.
+        With max_rows set, at most that many rows are fetched; rows past it are never
+        materialized as Python tuples.
         Returns a dictionary containing:
         - columns: List[str]
         - rows: List[Tuple]
+        - truncated: bool (True if rows were cut off at max_rows)
         - error: str (None if successful)
         """
-        conn = sqlite3.connect(self.db_path)
         try:
-            cursor = conn.cursor()
-            cursor.execute(sql)
-            
-            # Retrieve results
-            rows = cursor.fetchall()
-            
-            # Retrieve column names from description
-            if cursor.description:
-                columns = [description[0] for description in cursor.description]
-            else:
-                columns = []
+            # One connection is shared by all graph threads; SQLite serializes access anyway
+            with self._lock:
+                cursor = self._connection().execute(sql)
+                
+                # Retrieve results; one extra row tells us whether the cap cut anything off
+                truncated = False
+                if max_rows is None:
+                    rows = cursor.fetchall()
+                else:
+                    rows = cursor.fetchmany(max_rows + 1)
+                    truncated = len(rows) > max_rows
+                    del rows[max_rows:]
                 
-            conn.close()
+                # Retrieve column names from description
+                if cursor.description:
+                    columns = [description[0] for description in cursor.description]
+                else:
+                    columns = []
             
             return {
                 "columns": columns,
                 "rows": rows,
+                "truncated": truncated,
                 "error": None
             }
             
         except sqlite3.Error as e:
-            conn.close()
             return {
                 "columns": [],
                 "rows": [],
+                "truncated": False,
                 "error": str(e) # This is vital for the Repair Loop
             }
 
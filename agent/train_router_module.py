@@ -6,8 +6,12 @@ Uses BootstrapFewShot optimizer with conservative settings for Phi-3.5 model.
 
 import dspy
 import os
+import re
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
@@ -104,74 +108,100 @@ train_examples = [
 ]
 
 # --- 2. METRIC ---
+_LABEL_RE = re.compile(r'\b(hybrid|sql|rag)\b')
+
+
+def _extract_label(s):
+    """Pulls the route label out of potentially verbose model output ('unknown' if absent)."""
+    m = _LABEL_RE.search(s.lower())
+    return m.group(1) if m else "unknown"
+
+
 def router_metric(example, pred, trace=None):
     """
     Simple metric that's tolerant of model instability.
     Returns True if predicted label matches gold label.
     """
     try:
-        gold = example.label.lower().strip()
-        predicted = pred.label.lower().strip()
-        
-        # Extract label from potentially verbose output
-        if "hybrid" in predicted:
-            predicted = "hybrid"
-        elif "sql" in predicted:
-            predicted = "sql"
-        elif "rag" in predicted:
-            predicted = "rag"
-        
-        return gold == predicted
+        return example.label.lower().strip() == _extract_label(pred.label)
     except:
         return False
 
 # --- 3. MANUAL EVALUATION ---
-def evaluate_router(router, examples, name="Router"):
-    """Synchronous evaluation with error handling"""
+class RateLimiter:
+    """Sliding-window limiter: at most `tokens_per_sec` calls start in any one-second window."""
+
+    def __init__(self, tokens_per_sec=5):
+        self.tokens_per_sec = tokens_per_sec
+        self.last_times = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.last_times and now - self.last_times[0] >= 1.0:
+                    self.last_times.popleft()
+                if len(self.last_times) < self.tokens_per_sec:
+                    self.last_times.append(now)
+                    return
+                wait = 1.0 - (now - self.last_times[0])
+            time.sleep(wait)
+
+
+def evaluate_router(router, examples, name="Router", max_workers=4, tokens_per_sec=5):
+    """Concurrent evaluation with error handling; only waits when the rate limit is actually hit"""
     correct = 0
     errors = 0
     total = len(examples)
-    
-    print(f"\nEvaluating {name} on {total} examples...")
-    for i, ex in enumerate(examples):
+    limiter = RateLimiter(tokens_per_sec)
+
+    def classify(ex):
         try:
-            time.sleep(0.3)  # Small delay between calls
+            limiter.acquire()
             pred = router(question=ex.question)
-            
-            # Extract label
-            raw_label = pred.label.lower().strip()
-            if "hybrid" in raw_label:
-                predicted = "hybrid"
-            elif "sql" in raw_label:
-                predicted = "sql"
-            elif "rag" in raw_label:
-                predicted = "rag"
-            else:
-                predicted = "unknown"
-            
-            is_correct = (predicted == ex.label)
-            if is_correct:
-                correct += 1
-            
-            symbol = "✓" if is_correct else "✗"
-            print(f"  [{i+1}/{total}] {ex.question[:30]:30s}... | Exp: {ex.label:6s} | Got: {predicted:6s} {symbol}")
-            
+            return _extract_label(pred.label), None
         except Exception as e:
+            return None, e
+
+    print(f"\nEvaluating {name} on {total} examples...")
+    with ThreadPoolExecutor(max_workers=max_workers) as ex_pool:
+        results = list(ex_pool.map(classify, examples))
+
+    for i, (ex, (predicted, error)) in enumerate(zip(examples, results)):
+        if error is not None:
             errors += 1
-            print(f"  [{i+1}/{total}] ERROR: {str(e)[:50]}...")
-    
+            print(f"  [{i+1}/{total}] ERROR: {str(error)[:50]}...")
+            continue
+
+        is_correct = (predicted == ex.label)
+        if is_correct:
+            correct += 1
+
+        symbol = "✓" if is_correct else "✗"
+        print(f"  [{i+1}/{total}] {ex.question[:30]:30s}... | Exp: {ex.label:6s} | Got: {predicted:6s} {symbol}")
+
     score = (correct / total) * 100 if total > 0 else 0
     print(f"\nResult: {correct}/{total} correct = {score:.1f}% ({errors} errors)")
     return score
 
 # --- 4. MAIN EXECUTION ---
+SAVE_PATH = "agent/dspy_modules/optimized_router.json"
+
 if __name__ == "__main__":
+    # The saved JSON is the frozen program the agent loads; only re-optimize when this
+    # script changed since it was written (or when forced)
+    if "--force" not in sys.argv and os.path.exists(SAVE_PATH) \
+            and os.path.getmtime(SAVE_PATH) > os.path.getmtime(__file__):
+        print(f"{SAVE_PATH} is up to date, skipping optimization (pass --force to retrain)")
+        sys.exit(0)
+
     print("=" * 70)
     print("DSPy Router Optimization - BootstrapFewShot")
     print("=" * 70)
     
-    # Setup LLM
-    lm = dspy.LM(model="ollama/phi3.5:3.8b-mini-instruct-q4_K_M", api_base="http://localhost:11434")
+    # Setup LLM (cache=True: repeat eval passes answer identical router prompts from DSPy's disk cache)
+    lm = dspy.LM(model="ollama/phi3.5:3.8b-mini-instruct-q4_K_M", api_base="http://localhost:11434", cache=True)
     dspy.settings.configure(lm=lm)
     
     # Step 1: Baseline
@@ -210,7 +240,7 @@ if __name__ == "__main__":
         print("=" * 70)
         
         # Save the better one
-        save_path = "agent/dspy_modules/optimized_router.json"
+        save_path = SAVE_PATH
         if not os.path.exists("agent/dspy_modules"):
             os.makedirs("agent/dspy_modules")
         
@@ -236,7 +266,7 @@ if __name__ == "__main__":
         print(f"Change:          0.0% (baseline deployed)")
         print("=" * 70)
         
-        save_path = "agent/dspy_modules/optimized_router.json"
+        save_path = SAVE_PATH
         if not os.path.exists("agent/dspy_modules"):
             os.makedirs("agent/dspy_modules")
         baseline_router.save(save_path)
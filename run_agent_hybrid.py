@@ -1,17 +1,85 @@
 import click
 import json
+import orjson
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
 
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from agent.graph_hybrid import app
+from agent.graph_hybrid import app, memory, make_initial_state
+
+# Output is flushed (and the .progress sidecar updated) once per this many answers
+FLUSH_EVERY = 16
+
+
+def _run_one(q_data, resume=False):
+    """Runs the agent on one question and returns its output payload (never raises)."""
+    q_id = q_data.get("id")
+    question_text = q_data.get("question")
+    format_hint = q_data.get("format_hint", "str")
+
+    # 1. Initialize State
+    initial_state = make_initial_state(q_id, question_text, format_hint)
+
+    # 2. Run Agent
+    # We use the Question ID as the thread_id to keep states separate
+    config = {"configurable": {"thread_id": str(q_id)}}
+
+    try:
+        snapshot = app.get_state(config) if resume else None
+        if snapshot and snapshot.values.get("final_output") and not snapshot.next:
+            # Finished in a previous run
+            print(f"   [{q_id}] Resumed: answer loaded from checkpoint")
+            final_state = snapshot.values
+        elif snapshot and snapshot.next:
+            # Interrupted mid-graph: continue from the last completed node
+            print(f"   [{q_id}] Resumed: continuing from {', '.join(snapshot.next)}")
+            final_state = app.invoke(None, config=config, recursion_limit=20)
+        else:
+            # Fresh run: drop any stale checkpoint so old channel values cannot leak in
+            memory.delete_thread(str(q_id))
+            # Invoke the graph
+            # recursion_limit=20 prevents infinite loops if something goes wrong
+            final_state = app.invoke(initial_state, config=config, recursion_limit=20)
+
+        # 3. Extract Output
+        output_payload = final_state.get("final_output")
+
+        # Fallback if something crashed internally and didn't produce output
+        if not output_payload:
+            output_payload = {
+                "id": q_id,
+                "final_answer": None,
+                "sql": "",
+                "confidence": 0.0,
+                "explanation": "Agent failed to produce an output payload.",
+                "citations": []
+            }
+
+    except Exception as e:
+        print(f"Error processing {q_id}: {e}")
+        output_payload = {
+            "id": q_id,
+            "final_answer": None,
+            "sql": "",
+            "confidence": 0.0,
+            "explanation": f"System Error: {str(e)}",
+            "citations": []
+        }
+
+    return output_payload
+
 
 @click.command()
 @click.option('--batch', required=True, help='Path to input JSONL file')
 @click.option('--out', required=True, help='Path to output JSONL file')
-def main(batch, out):
+@click.option('--resume', is_flag=True, help='Reuse checkpointed answers and continue interrupted questions')
+@click.option('--workers', type=int, default=lambda: int(os.environ.get("OLLAMA_NUM_PARALLEL", 4)), show_default="$OLLAMA_NUM_PARALLEL or 4",
+              help='Questions processed concurrently (match the Ollama server parallelism)')
+def main(batch, out, resume, workers):
     """
     Main entry point for the Retail Analytics Copilot.
     Runs the agent over a batch of questions and outputs results.
@@ -20,74 +88,75 @@ def main(batch, out):
     print(f"Input: {batch}")
     print(f"Output: {out}")
 
-    # Clear output file if exists to start fresh
-    if os.path.exists(out):
-        os.remove(out)
-
-    with open(batch, 'r', encoding='utf-8') as f_in, open(out, 'a', encoding='utf-8') as f_out:
-        lines = f_in.readlines()
-        total = len(lines)
-        
-        for i, line in enumerate(lines):
-            if not line.strip():
-                continue
-                
-            q_data = json.loads(line)
-            q_id = q_data.get("id")
-            question_text = q_data.get("question")
-            format_hint = q_data.get("format_hint", "str")
-            
-            print(f"\n[{i+1}/{total}] Processing ID: {q_id}")
-            
-            # 1. Initialize State
-            initial_state = {
-                "id": q_id,
-                "question": question_text,
-                "format_hint": format_hint,
-                "retries": 0,
-                "sql_results": {},
-                "retrieved_docs": []
-            }
-            
-            # 2. Run Agent
-            # We use the Question ID as the thread_id to keep states separate
-            config = {"configurable": {"thread_id": str(q_id)}}
-            
-            try:
-                # Invoke the graph
-                # recursion_limit=20 prevents infinite loops if something goes wrong
-                final_state = app.invoke(initial_state, config=config, recursion_limit=20)
-                
-                # 3. Extract Output
-                output_payload = final_state.get("final_output")
-                
-                # Fallback if something crashed internally and didn't produce output
-                if not output_payload:
-                    output_payload = {
-                        "id": q_id,
-                        "final_answer": None,
-                        "sql": "",
-                        "confidence": 0.0,
-                        "explanation": "Agent failed to produce an output payload.",
-                        "citations": []
-                    }
-                
-            except Exception as e:
-                print(f"Error processing {q_id}: {e}")
-                output_payload = {
-                    "id": q_id,
-                    "final_answer": None,
-                    "sql": "",
-                    "confidence": 0.0,
-                    "explanation": f"System Error: {str(e)}",
-                    "citations": []
-                }
-
-            # 4. Write to file immediately (Line-by-Line)
-            f_out.write(json.dumps(output_payload) + "\n")
-            f_out.flush() # Ensure it's saved even if script crashes later
+    progress_path = out + ".progress"
+    skip, last_id = 0, None
+    if resume and os.path.exists(progress_path) and os.path.exists(out):
+        # Keep exactly the lines the sidecar vouches for; anything after is a partial write
+        with open(progress_path, 'r', encoding='utf-8') as f:
+            progress = json.load(f)
+        os.truncate(out, progress["offset"])
+        skip, last_id = progress["done"], progress["last_id"]
+        print(f"Resuming after {skip} written answers (last ID: {progress['last_id']})")
+    else:
+        # Clear output file if exists to start fresh
+        for path in (out, progress_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def save_progress(count, last_id):
+        # Written only after a flush, then swapped in atomically, so it never runs ahead of the file
+        tmp = progress_path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"done": count, "last_id": last_id, "offset": os.path.getsize(out)}, f)
+        os.replace(tmp, progress_path)
+
+    # One cheap pass for the progress counter; questions themselves are streamed below
+    with open(batch, 'rb') as f:
+        total = sum(1 for line in f if line.strip())
+
+    with open(batch, 'rb') as f_in, open(out, 'ab') as f_out:
+        questions = (orjson.loads(line) for line in f_in if line.strip())
+        # Submit at most `window` questions beyond the last written one, so memory stays bounded
+        window = 2 * max(1, workers)
+
+        # LLM calls dominate and release the GIL, so threads are enough to keep Ollama busy
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            futures, ids = {}, {}
+            done, next_idx = {}, skip
+            next_submit = skip
+            for q_data in islice(questions, skip, skip + window):
+                futures[ex.submit(_run_one, q_data, resume)] = next_submit
+                ids[next_submit] = q_data.get("id")
+                next_submit += 1
+
+            # Results arrive in completion order; buffer them so the file keeps input order.
+            # Only this thread writes, so no lock is needed around the file.
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    i = futures.pop(fut)
+                    done[i] = fut.result()
+                    print(f"\n[{len(done) + next_idx}/{total}] Finished ID: {ids[i]}")
+
+                # 4. Write every contiguous finished result; flush (and record progress) in batches
+                while next_idx in done:
+                    f_out.write(orjson.dumps(done.pop(next_idx)) + b"\n")
+                    last_id = ids.pop(next_idx)
+                    next_idx += 1
+                    if next_idx % FLUSH_EVERY == 0:
+                        f_out.flush()
+                        save_progress(next_idx, last_id)
+
+                for q_data in islice(questions, max(0, next_idx + window - next_submit)):
+                    futures[ex.submit(_run_one, q_data, resume)] = next_submit
+                    ids[next_submit] = q_data.get("id")
+                    next_submit += 1
+
+        f_out.flush()
+        if next_idx:
+            save_progress(next_idx, last_id)
 
     print(f"\n--- Batch Run Complete. Results saved to {out} ---")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,34 @@
+"""
+Renders the agent graph to agent_graph.png (the image shown in README.md).
+
+Only the graph structure is needed here, so this script sets GRAPH_VIZ_ONLY=1 before
+importing agent.graph_hybrid. With that flag the import skips the LM setup and model
+warm-up, SQLite schema introspection, the retriever index and the checkpoint database.
+"""
+import click
+import os
+import sys
+
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate_graph_image(out_path: str = "agent_graph.png"):
+    """Draws the compiled graph as a PNG locally via Graphviz (needs pygraphviz)."""
+    os.environ.setdefault("GRAPH_VIZ_ONLY", "1")
+    # Imported here so that e.g. `--help` never builds the agent
+    from agent.graph_hybrid import app
+
+    png = app.get_graph().draw_png()
+    with open(out_path, "wb") as f:
+        f.write(png)
+    print(f"Graph image saved to {out_path}")
+
+
+@click.command()
+@click.option('--out', default='agent_graph.png', show_default=True, help='Path to output PNG file')
+def main(out):
+    generate_graph_image(out)
+
+if __name__ == '__main__':
+    main()